@@ -0,0 +1,113 @@
+"""Generates numba accelerated evaluation functions for the same matrices
+that generate_octave_funcs.py writes out as Octave files. The functions are
+lambdified NumPy code, written to disk as importable Python source, and
+just-in-time compiled with numba when it is installed so that repeated
+evaluation inside an ODE integration loop avoids interpreter dispatch."""
+
+import importlib.util
+import inspect
+import os
+import re
+import textwrap
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from nonlin_sym import *
+
+
+def _float32_variant(func):
+    """Returns a wrapper that evaluates ``func`` on float32 inputs and casts
+    the results to float32. Intended for large batch (e.g. Monte-Carlo)
+    sweeps where the memory traffic of the evaluated matrices dominates; use
+    the float64 versions for single high fidelity runs."""
+
+    def wrapper(*args):
+        args = [np.asarray(a, dtype=np.float32) for a in args]
+        return [np.asarray(o, dtype=np.float32) for o in func(*args)]
+
+    return wrapper
+
+
+def _write_module(name, func, path):
+    """Writes the source of a lambdified function to ``<path>/<name>.py`` as
+    a self contained module: the function is renamed from lambdify's
+    _lambdifygenerated to ``name`` and a ``from numpy import ...`` line
+    covering the NumPy names the source refers to is prepended. Returns the
+    file path."""
+
+    src = inspect.getsource(func).replace('_lambdifygenerated', name)
+    used = sorted(set(re.findall(r'\b[A-Za-z_]\w*\b', src)) & set(dir(np)))
+    header = textwrap.fill(
+        'from numpy import ({})'.format(', '.join(used)), width=79,
+        subsequent_indent='                   ')
+    fpath = os.path.join(path, name + '.py')
+    with open(fpath, 'w') as f:
+        f.write(header + '\n\n\n' + src)
+    return fpath
+
+
+def generate_numba_backends(path=None):
+    """Returns a dictionary mapping evaluator names to callables that
+    numerically evaluate the holonomic constraint, the dependent speed
+    matrices, and the dynamic equation matrices. The NumPy source of each
+    callable is written to ``<name>.py`` alongside the Octave files so that
+    integrator scripts can import the functions without rerunning the
+    symbolic derivation. If numba is installed each function is loaded back
+    from its file (so njit's on-disk cache can key off the source) and
+    wrapped with ``njit(cache=True, fastmath=True)``; a trial evaluation
+    guards against numba failing to type the generated code, in which case
+    the plain NumPy function is kept. A ``<name>_f32`` single precision
+    variant of each evaluator is also returned.
+
+    """
+
+    if path is None:
+        path = os.path.dirname(__file__)
+
+    matrices = {
+        'eval_holonomic': ([[q4, q5, q7], [d1, d2, d3, rf, rr]],
+                           [sm.Matrix([holonomic])]),
+        'eval_dep_speeds': ([[q3, q4, q5, q7], u_ind, [d1, d2, d3, rf, rr]],
+                            [A_nh, -B_nh]),
+        'eval_dynamic_eqs': ([qs, us, fs, rs, ps], [A_all, b_all]),
+    }
+
+    funcs = {}
+    for name, (args, mats) in matrices.items():
+        func = sm.lambdify(args, mats, modules='numpy', cse=True)
+        fpath = _write_module(name, func, path)
+        spec = importlib.util.spec_from_file_location(name, fpath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        plain = getattr(module, name)
+        func = plain
+        if numba is not None:
+            jitted = numba.njit(cache=True, fastmath=True)(func)
+            try:
+                jitted(*[np.ones(len(a)) for a in args])
+                func = jitted
+            except Exception as e:
+                print('numba could not compile {}, falling back to plain '
+                      'NumPy: {}'.format(name, e))
+        funcs[name] = func
+        # each dtype is a separate numba compilation, so the float32
+        # signature needs its own trial evaluation
+        f32 = _float32_variant(func)
+        if func is not plain:
+            try:
+                f32(*[np.ones(len(a)) for a in args])
+            except Exception as e:
+                print('numba could not compile the float32 signature of {}, '
+                      'falling back to plain NumPy: {}'.format(name, e))
+                f32 = _float32_variant(plain)
+        funcs[name + '_f32'] = f32
+    return funcs
+
+
+if __name__ == '__main__':
+    generate_numba_backends()
@@ -1,23 +1,236 @@
+import multiprocessing
 import os
 
-from pydy.codegen.octave_code import OctaveMatrixGenerator
-
 from nonlin_sym import *
+# this import must come after nonlin_sym: it initializes sympy.core.cache,
+# which reads SYMPY_CACHE_SIZE only once, and nonlin_sym sets that variable
+# before importing sympy
+from sympy.printing.octave import OctaveCodePrinter
+
+_M_TEMPLATE = """\
+function [{outputs}] = {prefix}({inputs})
+% function [{outputs}] = {prefix}({inputs})
+%
+{docstring}
+
+{subexprs}
+
+{assignments}
+
+end
+"""
+
+
+def _octave_printer(arguments):
+    """Returns an OctaveCodePrinter that prints each symbol or dynamicsymbol
+    in ``arguments`` as an indexed entry of the corresponding input array,
+    e.g. input_1(2)."""
+
+    index_map = {}
+    for i, arg_set in enumerate(arguments):
+        for j, var in enumerate(arg_set):
+            index_map[var] = 'input_{}({})'.format(i + 1, j + 1)
+
+    class _IndexedPrinter(OctaveCodePrinter):
+
+        def _print_Function(self, e):
+            if e in index_map:
+                return index_map[e]
+            return super()._print_Function(e)
+
+        def _print_Symbol(self, e):
+            if e in index_map:
+                return index_map[e]
+            return super()._print_Symbol(e)
+
+    return _IndexedPrinter()
+
+
+def emit_octave(prefix, arguments, subexprs, matrices, path=None,
+                single_precision=False):
+    """Writes ``<prefix>.m`` implementing an Octave function that evaluates
+    ``matrices`` given the input arrays described by ``arguments``. Each CSE
+    replacement is printed once as a scalar assignment followed by one
+    assignment per matrix entry, which avoids templating the fully printed
+    matrices and keeps the printer calls small.
+
+    Parameters
+    ==========
+    prefix : string
+        Name of the Octave function and of the file (without extension).
+    arguments : sequence of sequences of Symbol or Function
+        The variables making up each input array of the function.
+    subexprs : sequence of (Symbol, Expr) pairs
+        Common subexpression replacements, in dependency order.
+    matrices : sequence of Matrix
+        The matrices to evaluate, one output array per matrix.
+    path : string, optional
+        Directory to write the file to, defaults to this file's directory.
+    single_precision : boolean, optional
+        If true the inputs are cast to single at the top of the function and
+        the outputs are allocated as single, so the whole evaluation runs in
+        float32. Meant for large batch parameter sweeps where the memory
+        traffic of the evaluated matrices dominates; use the default double
+        versions for single high fidelity runs.
+
+    """
+
+    if path is None:
+        path = os.path.dirname(__file__)
+
+    printer = _octave_printer(arguments)
+
+    docstring = '\n'.join('% input_{} : [{}]'.format(
+        i + 1, ', '.join(str(v) for v in arg_set))
+        for i, arg_set in enumerate(arguments))
+
+    sub_lines = []
+    if single_precision:
+        sub_lines += ['    input_{0} = single(input_{0});'.format(i + 1)
+                      for i in range(len(arguments))]
+    sub_lines += ['    {} = {};'.format(lhs, printer.doprint(rhs))
+                  for lhs, rhs in subexprs]
+
+    assign_lines = []
+    for k, mat in enumerate(matrices):
+        nr, nc = mat.shape
+        if single_precision:
+            assign_lines.append(
+                "    output_{} = zeros({}, {}, 'single');".format(k + 1, nr,
+                                                                  nc))
+        else:
+            assign_lines.append('    output_{} = zeros({}, {});'.format(
+                k + 1, nr, nc))
+        for i in range(nr):
+            for j in range(nc):
+                # the output arrays start as zeros, so structurally zero
+                # entries (common in A_nh and the mass matrix block) need no
+                # assignment at all
+                if mat[i, j].is_zero:
+                    continue
+                assign_lines.append('    output_{}({}, {}) = {};'.format(
+                    k + 1, i + 1, j + 1, printer.doprint(mat[i, j])))
+
+    text = _M_TEMPLATE.format(
+        prefix=prefix,
+        inputs=', '.join('input_{}'.format(i + 1)
+                         for i in range(len(arguments))),
+        outputs=', '.join('output_{}'.format(k + 1)
+                          for k in range(len(matrices))),
+        docstring=docstring,
+        subexprs='\n'.join(sub_lines),
+        assignments='\n'.join(assign_lines),
+    )
+
+    with open(os.path.join(path, prefix + '.m'), 'w') as f:
+        f.write(text)
+
+
+def pooled_cse(matrix_groups, prefix='z'):
+    """Runs a single CSE pass over several groups of matrices. The generated
+    evaluators share most of their trigonometric subexpressions in q3, q4,
+    q5, and q7, so one pass builds the subexpression table once instead of
+    once per generator.
+
+    Parameters
+    ==========
+    matrix_groups : sequence of sequences of Matrix
+        The matrices destined for each generated file.
+
+    Returns
+    =======
+    results : list of (subexprs, matrices) tuples
+        One entry per group holding the replacement pairs needed by that
+        group (transitively) and the reduced matrices.
+
+    """
+
+    flat = []
+    for group in matrix_groups:
+        flat.extend(group)
+
+    replacements, reduced = sm.cse(flat, symbols=sm.numbered_symbols(prefix),
+                                   optimizations='basic')
+
+    results = []
+    idx = 0
+    for group in matrix_groups:
+        mats = reduced[idx:idx + len(group)]
+        idx += len(group)
+        # collect the replacements each group actually needs, including the
+        # subexpressions that other subexpressions are built from
+        needed = set().union(*[m.free_symbols for m in mats])
+        subexprs = []
+        for lhs, rhs in reversed(replacements):
+            if lhs in needed:
+                subexprs.append((lhs, rhs))
+                needed |= rhs.free_symbols
+        results.append((subexprs[::-1], mats))
+    return results
+
+
+# holonomic constraint, dependent speed matrices, dynamic equations and
+# normal forces
+_GENERIC_ARGS = [
+    ('eval_holonomic', [[q4, q5, q7], [d1, d2, d3, rf, rr]]),
+    ('eval_dep_speeds', [[q3, q4, q5, q7], u_ind, [d1, d2, d3, rf, rr]]),
+    ('eval_dynamic_eqs', [qs, us, fs, rs, ps]),
+]
+
+
+def _emit_nth(task):
+    n, single = task
+    prefix, arguments = _GENERIC_ARGS[n]
+    if single:
+        prefix += '_f32'
+    emit_octave(prefix, arguments, *_pooled[n], single_precision=single)
+
+
+def generate_specialized(const_values, suffix='_spec', path=None):
+    """Writes Octave evaluators with the numeric values of the constant
+    parameters substituted into the expressions before CSE and printing. For
+    a known bicycle geometry this collapses the constant subtrees at
+    generation time, so the emitted code is smaller and faster than the
+    generic evaluators and the constant argument disappears from the
+    generated function signatures.
+
+    Parameters
+    ==========
+    const_values : dict
+        Mapping of each constant in ``ps`` to a numerical value, e.g.
+        ``p_vals`` from simulate.py.
+    suffix : string, optional
+        Appended to the generic file names, e.g. ``eval_dynamic_eqs_spec.m``.
+    path : string, optional
+        Directory to write the .m files to, defaults to this file's
+        directory.
+
+    """
+
+    repl = {pi: sm.Float(const_values[pi]) for pi in ps}
+
+    specialized = pooled_cse([[sm.Matrix([holonomic]).xreplace(repl)],
+                              [A_nh.xreplace(repl), -B_nh.xreplace(repl)],
+                              [A_all.xreplace(repl), b_all.xreplace(repl)]])
+
+    emit_octave('eval_holonomic' + suffix, [[q4, q5, q7]], *specialized[0],
+                path=path)
+    emit_octave('eval_dep_speeds' + suffix, [[q3, q4, q5, q7], u_ind],
+                *specialized[1], path=path)
+    emit_octave('eval_dynamic_eqs' + suffix, [qs, us, fs, rs],
+                *specialized[2], path=path)
+
 
-# holonomic constraint
-gen = OctaveMatrixGenerator([[q4, q5, q7],
-                             [d1, d2, d3, rf, rr]],
-                            [sm.Matrix([holonomic])])
-gen.write('eval_holonomic', path=os.path.dirname(__file__))
-
-# nonholonomic constraints: calculate dependent speeds
-gen = OctaveMatrixGenerator([[q3, q4, q5, q7],
-                             u_ind,
-                             [d1, d2, d3, rf, rr]],
-                            [A_nh, -B_nh])
-gen.write('eval_dep_speeds', path=os.path.dirname(__file__))
-
-# dynamic equations and normal forces
-gen = OctaveMatrixGenerator([qs, us, fs, rs, ps],
-                            [A_all, b_all])
-gen.write('eval_dynamic_eqs', path=os.path.dirname(__file__))
+if __name__ == '__main__':
+    _pooled = pooled_cse([[sm.Matrix([holonomic])],
+                          [A_nh, -B_nh],
+                          [A_all, b_all]])
+    # The emissions only share the read-only pooled CSE results, so print
+    # them in parallel. Fork so the children inherit the symbolic results
+    # instead of re-deriving them at import. Each evaluator is written in
+    # double precision and as a single precision _f32 variant for batch
+    # sweeps.
+    tasks = [(n, single) for n in range(len(_GENERIC_ARGS))
+             for single in (False, True)]
+    with multiprocessing.get_context('fork').Pool(len(tasks)) as pool:
+        pool.map(_emit_nth, tasks)
